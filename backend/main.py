@@ -1,31 +1,62 @@
 import asyncio
-import json
-from fastapi import WebSocket, WebSocketDisconnect
-from fastapi import FastAPI, HTTPException
-from pydantic import BaseModel, Field
-from typing import Optional, List, Dict, Any
-import time, threading
+import orjson
+from fastapi import WebSocket
+from fastapi import FastAPI, HTTPException, Request, Response
+from fastapi.responses import ORJSONResponse
+from pydantic import BaseModel
+from dataclasses import dataclass, field, fields, asdict
+from typing import Optional, List, Dict, Any, Deque, Tuple
+import time
+from contextlib import asynccontextmanager, suppress
+import heapq
 from collections import deque
 import os
-
-app = FastAPI(title="Manufacturing Line Simulator")
+import math
+import tempfile
+from pathlib import Path
 
 # -----------------------------
 # In-memory state & data models
 # -----------------------------
-class Machine(BaseModel):
+@dataclass(slots=True)
+class Item:
+    item_id: int
+    created_at: float
+    lane: int = 0
+    type: str = "A"   # placeholder for future item types
+    start_time: float = 0.0
+    entered_machine_at: float = -1.0   # < 0 until the item first starts processing
+
+@dataclass(slots=True)
+class Machine:
+    """Runtime machine state; mutated every tick, so kept out of Pydantic."""
     id: int
     name: str
     next: Optional[int] = None
     takt_time: float = 1.0
     buffer: int = 1
     lane: int = 0
-    in_progress: List[Dict[str, Any]] = Field(default_factory=list)
-    queue: List[Dict[str, Any]] = Field(default_factory=list)
+    current_item: Optional[Item] = None
+    finish_time: float = math.inf   # when current_item is done; inf while idle
+    queue: Deque[Item] = field(default_factory=deque)
     completed: int = 0
-    busy_time: float = 0.0
+    # busy_time is derived; these hold what had accrued at the last takt_time change
+    busy_time_base: float = 0.0
+    completed_at_base: int = 0
     last_state_change: float = 0.0
     blocked: bool = False
+    # Resolved `next`; refreshed by rebuild_topology() whenever wiring changes
+    _next_ref: Optional["Machine"] = field(default=None, repr=False, compare=False)
+
+    @property
+    def busy_time(self) -> float:
+        return self.busy_time_base + (self.completed - self.completed_at_base) * self.takt_time
+
+    def set_takt_time(self, takt_time: float):
+        """Change takt_time, banking the busy time accrued at the old rate."""
+        self.busy_time_base = self.busy_time
+        self.completed_at_base = self.completed
+        self.takt_time = takt_time
 
 class UpdateMachineRequest(BaseModel):
     id: int
@@ -53,32 +84,59 @@ class StateSnapshot(BaseModel):
     total_started: int
     total_completed: int
     avg_cycle_time: float
+    rolling_throughput: float
     machines: List[Dict[str, Any]]
     running: bool
 
 # --- WebSocket connection manager ---
 class WSManager:
+    send_timeout = 2.0   # seconds before a stalled client is dropped
+    queue_size = 8       # pending messages per client before the oldest is dropped
+
     def __init__(self):
-        self.active: set[WebSocket] = set()
+        # Each client gets an outbound queue drained by its own writer task, so
+        # producers never await a socket and a slow client only delays itself
+        self.active: Dict[WebSocket, asyncio.Queue] = {}
+        self._writers: Dict[WebSocket, asyncio.Task] = {}
 
     async def connect(self, ws: WebSocket):
         await ws.accept()
-        self.active.add(ws)
+        q: asyncio.Queue = asyncio.Queue(maxsize=self.queue_size)
+        self.active[ws] = q
+        self._writers[ws] = asyncio.create_task(self._writer(ws, q))
 
     def disconnect(self, ws: WebSocket):
-        self.active.discard(ws)
+        self.active.pop(ws, None)
+        task = self._writers.pop(ws, None)
+        if task is not None and task is not asyncio.current_task():
+            task.cancel()
 
-    async def broadcast(self, msg: str):
-        if not self.active:
+    async def _writer(self, ws: WebSocket, q: asyncio.Queue):
+        try:
+            while True:
+                msg = await q.get()
+                await asyncio.wait_for(ws.send_text(msg), timeout=self.send_timeout)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            self.disconnect(ws)
+            # Close it too, so the browser's onclose fires and it reconnects (or
+            # falls back to polling) instead of silently getting no more frames
+            with suppress(Exception):
+                await asyncio.wait_for(ws.close(code=1011), timeout=self.send_timeout)
+
+    def send(self, ws: WebSocket, msg: str):
+        """Queue msg for one client; if it is behind, drop its oldest pending message."""
+        q = self.active.get(ws)
+        if q is None:
             return
-        dead = []
+        if q.full():
+            q.get_nowait()
+        q.put_nowait(msg)
+
+    def broadcast(self, msg: str):
         for ws in list(self.active):
-            try:
-                await ws.send_text(msg)
-            except Exception:
-                dead.append(ws)
-        for ws in dead:
-            self.disconnect(ws)
+            self.send(ws, msg)
 
 ws_manager = WSManager()
 
@@ -88,155 +146,281 @@ machines: List[Machine] = [
     Machine(id=2, name="Assembly",  next=3, takt_time=7.5, buffer=2, lane=0),
     Machine(id=3, name="Packaging", next=None, takt_time=3.0, buffer=1, lane=0),
 ]
+# id -> Machine; kept in sync with `machines` by every endpoint that adds/removes
+id_index: Dict[int, Machine] = {m.id: m for m in machines}
+# Derived from `machines` by rebuild_topology(): id -> list position,
+# id -> machines whose `next` points at it, the spawn points (machines
+# nothing in their own lane feeds) ordered by lane, and lane -> last machine
+position_index: Dict[int, int] = {}
+upstream_index: Dict[int, List[Machine]] = {}
+spawn_sources: List[Machine] = []
+lane_tails: Dict[int, Machine] = {}
 
 # Global simulation state
-state_lock = threading.Lock()
+# The sim task and every handler share one event loop; the lock marks the
+# critical sections that mutate the line.
+state_lock = asyncio.Lock()
 running = False
-sim_thread: Optional[threading.Thread] = None
-
-# Simulation clock
+sim_task: Optional[asyncio.Task] = None
+pump_task: Optional[asyncio.Task] = None
+# The sim task sleeps until the next event is due or this is set by
+# state_changed(); created in lifespan so it binds to the serving loop.
+sim_wakeup: Optional[asyncio.Event] = None
+# Set (then replaced by a fresh Event) on every publish_snapshot(), so the
+# snapshot pump can sleep until there is something new to send
+snapshot_published: Optional[asyncio.Event] = None
+# The pump broadcasts at most once per WS_MIN_INTERVAL, and while running at
+# least once per WS_REFRESH so progress bars keep moving between events
+WS_MIN_INTERVAL = 0.1
+WS_REFRESH = 1.0
+
+# Simulation clock. _last_wall is a time.monotonic() reading, so NTP or DST
+# adjustments of the system clock can't jump sim_time.
 sim_time = 0.0
-_last_wall = time.time()
+_last_wall = time.monotonic()
+
+# Every completion is an event settled on the serving loop, so very short takt
+# times would swamp it (and below float resolution of sim_time, never advance)
+MIN_TAKT_TIME = 0.01
+# Events handled per advance_simulation(); past this the clock carries the rest
+# as lag and the loop yields, so HTTP/WS traffic keeps being served
+MAX_EVENTS_PER_WAKEUP = 1000
+
+# Pending (finish_time, machine_id) events, earliest first
+event_heap: List[Tuple[float, int]] = []
+# Set by state_changed(): an endpoint edited the line, so settle once at "now"
+settle_pending = False
+
+# Published view of the line. publish_snapshot() rebuilds it under state_lock;
+# readers just take the reference, which is always a complete snapshot.
+latest_snapshot: Dict[str, Any] = {}
+state_version = 0
+# (state_version it was built for, encoded body) behind GET /machines
+_machines_dump: Tuple[int, bytes] = (-1, b"")
+# (state_version, monotonic time rendered, encoded body) of the last state
+# payload; shared by /state polls and /ws/state pushes
+_state_cache: Tuple[int, float, bytes] = (-1, 0.0, b"")
+# While running, readers inside this window share one rendered payload
+STATE_CACHE_TTL = 0.1
+# Versions restart with the process; prefix ETags so old ones never match
+_boot_id = format(int(time.time() * 1000), "x")
 
 # Metrics
 total_started = 0
 total_completed = 0
-cycle_times: List[float] = []
+items_in_system = 0    # +1 on spawn, -1 whenever an item leaves the line
+cycle_time_sum = 0.0   # avg cycle time = cycle_time_sum / total_completed
 item_id_seq = 0
-completions = deque(maxlen=5000)
+# Sim times of completions within the last ROLLING_WINDOW sim seconds (oldest first)
+ROLLING_WINDOW = 60.0
+completions: Deque[float] = deque()
+# Free-list of finished items, reused by spawn to cut allocator/GC churn
+item_pool: Deque[Item] = deque(maxlen=1024)
 
 SAVE_PATH = os.path.join(os.path.dirname(__file__), "sim_state.json")
+# Held across encode + write so overlapping saves land in request order
+save_lock = asyncio.Lock()
 
 # -----------------------------
 # Simulation engine
 # -----------------------------
-TICK_SEC = 0.1
-
 def get_machine(mid: int) -> Machine:
-    for m in machines:
-        if m.id == mid:
-            return m
-    raise KeyError(f"Machine {mid} not found")
+    return id_index[mid]
 
-def lanes_present() -> List[int]:
-    return sorted(set(m.lane for m in machines))
+def rebuild_topology():
+    """Re-derive next refs and the position/upstream indices after any wiring change."""
+    position_index.clear()
+    upstream_index.clear()
+    fed = set()
+    for i, m in enumerate(machines):
+        m._next_ref = id_index.get(m.next) if m.next is not None else None
+        position_index[m.id] = i
+        if m.next is not None:
+            upstream_index.setdefault(m.next, []).append(m)
+            if m._next_ref is not None and m._next_ref.lane == m.lane:
+                fed.add(m.next)
+    spawn_sources[:] = sorted((m for m in machines if m.id not in fed), key=lambda m: m.lane)
+
+    # Tail of each lane: follow same-lane links from its first head (or, for a
+    # lane that is one closed loop, its first machine) until the chain leaves
+    heads: Dict[int, Machine] = {}
+    for m in spawn_sources:
+        heads.setdefault(m.lane, m)
+    lane_tails.clear()
+    for m in machines:
+        if m.lane in lane_tails:
+            continue
+        cur = heads.get(m.lane, m)
+        seen = set()
+        while cur._next_ref is not None and cur._next_ref.lane == m.lane and cur.id not in seen:
+            seen.add(cur.id)
+            cur = cur._next_ref
+        lane_tails[m.lane] = cur
 
-def lane_sources(lane: int) -> List[Machine]:
-    """Machines in lane that are not a 'next' target in that same lane."""
-    lane_ms = [m for m in machines if m.lane == lane]
-    idmap = {m.id: m for m in lane_ms}
-    targets = {m.next for m in lane_ms if m.next is not None and m.next in idmap}
-    return [m for m in lane_ms if m.id not in targets]
+rebuild_topology()
 
 def lane_tail(lane: int) -> Optional[Machine]:
-    """Follow pointers within a lane to find its tail (last machine)."""
-    lane_ms = [m for m in machines if m.lane == lane]
-    if not lane_ms:
-        return None
-    idmap = {m.id: m for m in lane_ms}
-    # find sources (heads)
-    targets = {m.next for m in lane_ms if m.next is not None and m.next in idmap}
-    heads = [m for m in lane_ms if m.id not in targets] or [lane_ms[0]]
-    cur = heads[0]
-    seen = set()
-    while True:
-        if cur.next is None or cur.next not in idmap or cur.id in seen:
-            return cur
-        seen.add(cur.id)
-        cur = idmap[cur.next]
+    """Last machine of lane (None if the lane is empty); see rebuild_topology()."""
+    return lane_tails.get(lane)
 
-def start_processing_if_possible(m: Machine, current_time: float):
+def start_processing_if_possible(m: Machine, current_time: float) -> bool:
     if m.blocked:
-        return
-    if len(m.in_progress) == 0 and len(m.queue) > 0:
-        item = m.queue.pop(0)
-        item["start_time"] = current_time
-        if "entered_machine_at" not in item:
-            item["entered_machine_at"] = current_time
-        m.in_progress.append(item)
+        return False
+    if m.current_item is None and len(m.queue) > 0:
+        item = m.queue.popleft()
+        item.start_time = current_time
+        if item.entered_machine_at < 0:
+            item.entered_machine_at = current_time
+        m.current_item = item
+        m.finish_time = current_time + m.takt_time
         m.last_state_change = current_time
+        heapq.heappush(event_heap, (m.finish_time, m.id))
+        return True
+    return False
 
-def try_push_to_next(m: Machine, current_time: float):
-    if len(m.in_progress) == 0:
-        m.blocked = False
-        return
-
-    item = m.in_progress[0]
-    elapsed = current_time - item["start_time"]
-
-    if elapsed < m.takt_time:
+def try_push_to_next(m: Machine, current_time: float) -> bool:
+    # Idle machines have finish_time = inf, so this one compare covers them too
+    if current_time < m.finish_time:
         m.blocked = False
-        return
+        return False
 
-    nxt = m.next
-    if nxt is None:
-        m.in_progress.pop(0)
+    item = m.current_item
+    next_m = m._next_ref
+    if next_m is None:
+        m.current_item = None
+        m.finish_time = math.inf
         m.completed += 1
-        m.busy_time += m.takt_time
         m.last_state_change = current_time
         m.blocked = False
 
-        global total_completed, cycle_times
+        global total_completed, cycle_time_sum, items_in_system
         total_completed += 1
-        cycle_times.append(current_time - item["created_at"])
+        items_in_system -= 1
+        cycle_time_sum += current_time - item.created_at
         completions.append(current_time)
-        return
+        item_pool.append(item)
+        return True
 
-    next_m = get_machine(nxt)
     # Only push if next has buffer (lane is already enforced when wiring)
     if len(next_m.queue) < next_m.buffer:
-        m.in_progress.pop(0)
+        m.current_item = None
+        m.finish_time = math.inf
         m.completed += 1
-        m.busy_time += m.takt_time
         m.last_state_change = current_time
         m.blocked = False
         next_m.queue.append(item)
-    else:
-        # Finished but cannot push → blocked
-        m.blocked = True
-
-def spawn_new_items_per_lane(current_time: float):
+        return True
+    # Finished but cannot push → blocked
+    m.blocked = True
+    return False
+
+def new_item(item_id: int, created_at: float, lane: int) -> Item:
+    """Take an Item off the free-list (or allocate one) and initialise it."""
+    if not item_pool:
+        return Item(item_id=item_id, created_at=created_at, lane=lane)
+    item = item_pool.popleft()
+    item.item_id = item_id
+    item.created_at = created_at
+    item.lane = lane
+    item.type = "A"
+    item.start_time = 0.0
+    item.entered_machine_at = -1.0
+    return item
+
+def spawn_new_items_per_lane(current_time: float) -> bool:
     """For each lane, spawn into each source machine if it has space."""
-    global item_id_seq, total_started
-    for lane in lanes_present():
-        for src in lane_sources(lane):
-            if len(src.queue) < src.buffer:
-                item_id_seq += 1
-                item = {
-                    "item_id": item_id_seq,
-                    "created_at": current_time,
-                    "lane": lane,
-                    "type": "A",   # placeholder for future item types
-                }
-                src.queue.append(item)
-                total_started += 1
-
-def simulation_loop():
-    global running, sim_time, _last_wall
+    global item_id_seq, total_started, items_in_system
+    spawned = False
+    for src in spawn_sources:
+        if len(src.queue) < src.buffer:
+            item_id_seq += 1
+            src.queue.append(new_item(item_id_seq, current_time, src.lane))
+            total_started += 1
+            items_in_system += 1
+            spawned = True
+    return spawned
+
+def settle(current_time: float):
+    """Run push/pull/spawn passes at current_time until nothing else moves."""
+    changed = True
+    while changed:
+        changed = False
+        # Keep these as separate passes: the order decides who wins a freed
+        # queue slot (e.g. spawn vs. a cross-lane feeder), so fusing push and
+        # pull into one downstream-first pass changes multi-lane results
+        for m in reversed(machines):
+            changed |= try_push_to_next(m, current_time)
+        for m in machines:
+            changed |= start_processing_if_possible(m, current_time)
+        changed |= spawn_new_items_per_lane(current_time)
+
+def advance_clock():
+    global sim_time, _last_wall
+    now_wall = time.monotonic()
+    if running:
+        sim_time += max(now_wall - _last_wall, 0.0)
+    _last_wall = now_wall
+
+def advance_simulation():
+    """Catch the clock up to wall time and fire every event that fell due, in order."""
+    global settle_pending, sim_time, _last_wall
+    advance_clock()
+    if not running:
+        return
+    budget = MAX_EVENTS_PER_WAKEUP
+    while event_heap and event_heap[0][0] <= sim_time:
+        if budget == 0:
+            # Too far behind to catch up in one go: stop the clock at the last
+            # settled event and hand the remainder to the next wakeup as lag
+            _last_wall -= sim_time - last_t
+            sim_time = last_t
+            break
+        t, mid = heapq.heappop(event_heap)
+        m = id_index.get(mid)
+        if m is None or m.finish_time != t:
+            continue   # stale: machine removed or its takt_time changed
+        # settle() sweeps every machine, so one pass covers all events due at t
+        while event_heap and event_heap[0][0] == t:
+            heapq.heappop(event_heap)
+        settle(t)
+        budget -= 1
+        last_t = t
+    if settle_pending:
+        settle_pending = False
+        settle(sim_time)
+    publish_snapshot()
+
+def reschedule_events():
+    """Rebuild event_heap from the items currently being processed."""
+    event_heap.clear()
+    for m in machines:
+        if m.current_item is not None:
+            # Blocked machines finished before sim_time; settling them at that old
+            # time would start and spawn items in the past
+            m.finish_time = max(m.finish_time, sim_time)
+            event_heap.append((m.finish_time, m.id))
+    heapq.heapify(event_heap)
+
+def state_changed():
+    """Republish the view and wake the sim task to reschedule (hold state_lock)."""
+    global settle_pending
+    settle_pending = True
+    publish_snapshot()
+    if sim_wakeup is not None:
+        sim_wakeup.set()
+
+async def simulation_loop():
     while True:
-        with state_lock:
-            now_wall = time.time()
-            if running:
-                dt = max(now_wall - _last_wall, 0.0)
-                sim_time += dt
-
-                for m in machines[::-1]:
-                    try_push_to_next(m, sim_time)
-                for m in machines:
-                    start_processing_if_possible(m, sim_time)
-                spawn_new_items_per_lane(sim_time)
-
-            _last_wall = now_wall
-        time.sleep(TICK_SEC)
-
-def ensure_thread():
-    global sim_thread
-    if sim_thread is None or not sim_thread.is_alive():
-        t = threading.Thread(target=simulation_loop, daemon=True)
-        t.start()
-        sim_thread = t
-
-ensure_thread()
+        async with state_lock:
+            advance_simulation()
+            timeout = None
+            if running and event_heap:
+                timeout = max(event_heap[0][0] - sim_time, 0.0)
+        try:
+            await asyncio.wait_for(sim_wakeup.wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        sim_wakeup.clear()
 
 # -----------------------------
 # Helpers / state build
@@ -245,85 +429,225 @@ def next_id() -> int:
     return (max((m.id for m in machines), default=0) + 1)
 
 def index_of(mid: int) -> int:
-    for i, m in enumerate(machines):
-        if m.id == mid:
-            return i
-    raise KeyError
+    return position_index[mid]
 
 def upstream_of(target_id: int) -> List[Machine]:
-    return [m for m in machines if m.next == target_id]
+    return list(upstream_index.get(target_id, ()))
 
-def build_state_dict() -> Dict[str, Any]:
-    t = sim_time
-    in_system = sum(len(m.queue) + len(m.in_progress) for m in machines)
-    throughput = (total_completed / t) if t > 0 else 0.0
-    avg_ct = (sum(cycle_times) / len(cycle_times)) if cycle_times else 0.0
+def machine_to_dict(m: Machine) -> Dict[str, Any]:
+    return {
+        "id": m.id,
+        "name": m.name,
+        "next": m.next,
+        "takt_time": m.takt_time,
+        "buffer": m.buffer,
+        "lane": m.lane,
+        "in_progress": [asdict(m.current_item)] if m.current_item is not None else [],
+        "queue": [asdict(it) for it in m.queue],
+        "completed": m.completed,
+        "busy_time": m.busy_time,
+        "last_state_change": m.last_state_change,
+        "blocked": m.blocked,
+    }
 
-    machines_view = []
+# Keys a save file may set; anything else (unknown or runtime-only) is ignored,
+# as the old Pydantic model did
+_MACHINE_SAVE_KEYS = {f.name for f in fields(Machine)} - {
+    "current_item", "finish_time", "queue", "busy_time_base", "completed_at_base", "_next_ref"
+}
+_ITEM_SAVE_KEYS = {f.name for f in fields(Item)}
+
+def item_from_dict(d: Dict[str, Any]) -> Item:
+    return Item(**{k: v for k, v in d.items() if k in _ITEM_SAVE_KEYS})
+
+def machine_from_dict(md: Dict[str, Any]) -> Machine:
+    in_progress = md.get("in_progress", [])
+    queue = md.get("queue", [])
+    busy_time = md.get("busy_time", 0.0)
+    m = Machine(**{k: v for k, v in md.items() if k in _MACHINE_SAVE_KEYS})
+    # Older or hand-edited saves may predate the floor
+    m.takt_time = max(m.takt_time, MIN_TAKT_TIME)
+    m.busy_time_base = busy_time
+    m.completed_at_base = m.completed
+    m.queue = deque(item_from_dict(it) for it in queue)
+    if in_progress:
+        m.current_item = item_from_dict(in_progress[0])
+        m.finish_time = m.current_item.start_time + m.takt_time
+    return m
+
+def rolling_throughput(t: float) -> float:
+    """Items/s over the ROLLING_WINDOW sim seconds ending at t; decays to 0 when output stops."""
+    if t <= 0:
+        return 0.0
+    cutoff = t - ROLLING_WINDOW
+    recent = len(completions)
+    # publish_snapshot prunes up to its sim_time; skip what aged out since then
+    for c in completions:
+        if c > cutoff:
+            break
+        recent -= 1
+    return recent / min(ROLLING_WINDOW, t)
+
+def publish_snapshot():
+    """Capture the current line into a new immutable snapshot (hold state_lock)."""
+    global latest_snapshot, state_version, snapshot_published
+    cutoff = sim_time - ROLLING_WINDOW
+    while completions and completions[0] <= cutoff:
+        completions.popleft()
+    rows = []
     for m in machines:
+        it = m.current_item
+        status = "processing" if it is not None else ("idle" if len(m.queue) == 0 else "queued")
+        rows.append((
+            {
+                "id": m.id,
+                "name": m.name,
+                "next": m.next,
+                "lane": m.lane,
+                "status": status,
+                "in_progress": 0 if it is None else 1,
+                "in_progress_detail": None,   # time-dependent, filled per read
+                "queue": len(m.queue),
+                "buffer": m.buffer,
+                "takt_time": m.takt_time,
+                "completed": m.completed,
+                "utilization": 0.0,           # time-dependent, filled per read
+                "blocked": m.blocked
+            },
+            m.busy_time,
+            (it.item_id, it.start_time) if it else None,
+        ))
+    state_version += 1
+    latest_snapshot = {
+        "version": state_version,
+        "sim_time": sim_time,
+        "wall": _last_wall,
+        "running": running,
+        "items_in_system": items_in_system,
+        "total_started": total_started,
+        "total_completed": total_completed,
+        "cycle_time_sum": cycle_time_sum,
+        "rows": rows,
+    }
+    if snapshot_published is not None:
+        snapshot_published.set()
+        snapshot_published = asyncio.Event()
+
+def build_state_dict(snap: Optional[Dict[str, Any]] = None) -> Dict[str, Any]:
+    """Render a published snapshot (default: the latest) at the current wall time; needs no lock."""
+    if snap is None:
+        snap = latest_snapshot
+    t = snap["sim_time"]
+    if snap["running"]:
+        t += max(time.monotonic() - snap["wall"], 0.0)
+    done = snap["total_completed"]
+    throughput = (done / t) if t > 0 else 0.0
+    avg_ct = (snap["cycle_time_sum"] / done) if done else 0.0
+
+    machines_view = []
+    for row, busy_time, current in snap["rows"]:
         detail = []
-        if m.in_progress:
-            it = m.in_progress[0]
-            p = min(max((t - it["start_time"]) / m.takt_time, 0.0), 1.0)
-            detail.append({"item_id": it.get("item_id", -1), "progress": p})
-        status = "processing" if len(m.in_progress) > 0 else ("idle" if len(m.queue) == 0 else "queued")
+        if current is not None:
+            item_id, start_time = current
+            p = min(max((t - start_time) / row["takt_time"], 0.0), 1.0)
+            detail.append({"item_id": item_id, "progress": p})
         machines_view.append({
-            "id": m.id,
-            "name": m.name,
-            "next": m.next,
-            "lane": m.lane,
-            "status": status,
-            "in_progress": len(m.in_progress),
+            **row,
             "in_progress_detail": detail,
-            "queue": len(m.queue),
-            "buffer": m.buffer,
-            "takt_time": m.takt_time,
-            "completed": m.completed,
-            "utilization": (m.busy_time / t) if t > 0 else 0.0,
-            "blocked": m.blocked
+            "utilization": (busy_time / t) if t > 0 else 0.0,
         })
 
     return {
         "timestamp": round(t, 2),
-        "items_in_system": in_system,
+        "items_in_system": snap["items_in_system"],
         "throughput": round(throughput, 4),
-        "total_started": total_started,
-        "total_completed": total_completed,
+        "total_started": snap["total_started"],
+        "total_completed": done,
         "avg_cycle_time": round(avg_ct, 3),
+        "rolling_throughput": round(rolling_throughput(t), 4),
         "machines": machines_view,
-        "running": running,
+        "running": snap["running"],
     }
 
+def state_payload(snap: Dict[str, Any]) -> bytes:
+    """Encoded state for snap (the latest snapshot), rendered at most once per version/TTL."""
+    global _state_cache
+    version, rendered_at, body = _state_cache
+    now = time.monotonic()
+    # Paused bodies depend only on the version; running ones move with the clock
+    if version != snap["version"] or (snap["running"] and now - rendered_at >= STATE_CACHE_TTL):
+        body = orjson.dumps(build_state_dict(snap))
+        _state_cache = (snap["version"], now, body)
+    return body
+
+publish_snapshot()
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    global sim_task, pump_task, sim_wakeup, snapshot_published
+    sim_wakeup = asyncio.Event()
+    snapshot_published = asyncio.Event()
+    sim_task = asyncio.create_task(simulation_loop())
+    pump_task = asyncio.create_task(snapshot_pump())
+    yield
+    # Stop both loops and wait for them, so reloads and test clients don't leak tasks
+    for task in (pump_task, sim_task):
+        task.cancel()
+        with suppress(asyncio.CancelledError):
+            await task
+    sim_task = pump_task = None
+
+app = FastAPI(
+    title="Manufacturing Line Simulator",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse,
+)
+
 # -----------------------------
 # API routes
 # -----------------------------
 @app.get("/")
-def root():
+async def root():
     return {"message": "Manufacturing Line Simulator API. See /docs for endpoints."}
 
 @app.get("/machines")
-def get_machines():
-    with state_lock:
-        return [m.model_dump() for m in machines]
+async def get_machines():
+    global _machines_dump
+    version, body = _machines_dump
+    if version != state_version:
+        async with state_lock:
+            body = orjson.dumps([machine_to_dict(m) for m in machines])
+            _machines_dump = (state_version, body)
+    return Response(content=body, media_type="application/json")
 
 @app.post("/update_machine")
-def update_machine(req: UpdateMachineRequest):
-    with state_lock:
+async def update_machine(req: UpdateMachineRequest):
+    async with state_lock:
         try:
             m = get_machine(req.id)
         except KeyError:
             raise HTTPException(status_code=404, detail="Machine not found")
 
+        # Validate everything before touching m: readers only see published
+        # snapshots, so a half-applied edit that raised would never show up
         provided = req.model_dump(exclude_unset=True)
+        if "takt_time" in provided and (req.takt_time is None or req.takt_time < MIN_TAKT_TIME):
+            raise HTTPException(status_code=400, detail=f"takt_time must be >= {MIN_TAKT_TIME}")
+        if "buffer" in provided and (req.buffer is None or req.buffer < 0):
+            raise HTTPException(status_code=400, detail="buffer must be >= 0")
+
+        # Settle anything already due under the old parameters first
+        advance_simulation()
 
         if "takt_time" in provided:
-            if req.takt_time is None or req.takt_time <= 0:
-                raise HTTPException(status_code=400, detail="takt_time must be > 0")
-            m.takt_time = float(req.takt_time)
+            m.set_takt_time(float(req.takt_time))
+            if m.current_item is not None:
+                # A shorter takt can't finish the item in the past: that would
+                # replay completions that never happened before the edit
+                m.finish_time = max(m.current_item.start_time + m.takt_time, sim_time)
+                heapq.heappush(event_heap, (m.finish_time, m.id))
 
         if "buffer" in provided:
-            if req.buffer is None or req.buffer < 0:
-                raise HTTPException(status_code=400, detail="buffer must be >= 0")
             m.buffer = int(req.buffer)
 
         if "name" in provided:
@@ -331,10 +655,13 @@ def update_machine(req: UpdateMachineRequest):
 
         if "next" in provided:
             m.next = req.next
+            rebuild_topology()
 
         if "lane" in provided:
             m.lane = int(req.lane) if req.lane is not None else 0
+            rebuild_topology()
 
+        state_changed()
         return {
             "message": "Machine updated",
             "machine": {
@@ -344,8 +671,11 @@ def update_machine(req: UpdateMachineRequest):
         }
 
 @app.post("/add_machine")
-def add_machine(req: AddMachineRequest):
-    with state_lock:
+async def add_machine(req: AddMachineRequest):
+    if req.takt_time < MIN_TAKT_TIME:
+        raise HTTPException(status_code=400, detail=f"takt_time must be >= {MIN_TAKT_TIME}")
+    async with state_lock:
+        advance_simulation()
         new_id = next_id()
 
         # Create machine; lane may be adjusted if inserting after a specific machine
@@ -379,6 +709,8 @@ def add_machine(req: AddMachineRequest):
                     new_m.next = None
 
             machines.insert(idx + 1, new_m)
+            id_index[new_id] = new_m
+            rebuild_topology()
 
         else:
             # Append at the tail of the requested lane
@@ -397,137 +729,212 @@ def add_machine(req: AddMachineRequest):
                     except KeyError:
                         new_m.next = None
             machines.append(new_m)
+            id_index[new_id] = new_m
+            rebuild_topology()
 
-        return {"message": "Machine added", "machine": new_m.model_dump()}
+        state_changed()
+        return {"message": "Machine added", "machine": machine_to_dict(new_m)}
 
 @app.post("/remove_machine")
-def remove_machine(req: RemoveMachineRequest):
-    with state_lock:
+async def remove_machine(req: RemoveMachineRequest):
+    global total_completed, cycle_time_sum, items_in_system
+    async with state_lock:
         try:
             idx = index_of(req.id)
         except KeyError:
             raise HTTPException(status_code=404, detail="Machine not found")
+        advance_simulation()
         victim = machines[idx]
 
         # Rewire only upstream machines (any lane) that pointed to victim
         for u in upstream_of(victim.id):
             u.next = victim.next
 
-        # Migrate WIP/queue downstream
-        if victim.in_progress:
-            item = victim.in_progress.pop(0)
-            item["start_time"] = sim_time
-            if victim.next is not None:
-                get_machine(victim.next).queue.append(item)
+        # Migrate WIP/queue downstream. Like try_push_to_next, a `next` that
+        # doesn't resolve (or points back at victim) means end of line
+        dest = victim._next_ref if victim._next_ref is not victim else None
+        if victim.current_item is not None:
+            item = victim.current_item
+            victim.current_item = None
+            item.start_time = sim_time
+            if dest is not None:
+                dest.queue.append(item)
+            else:
+                items_in_system -= 1   # nowhere to go: the in-process item is dropped
         while victim.queue:
-            if victim.next is not None:
-                get_machine(victim.next).queue.append(victim.queue.pop(0))
+            if dest is not None:
+                dest.queue.append(victim.queue.popleft())
             else:
-                global total_completed, cycle_times
-                it = victim.queue.pop(0)
+                it = victim.queue.popleft()
                 total_completed += 1
-                cycle_times.append(sim_time - it["created_at"])
+                items_in_system -= 1
+                cycle_time_sum += sim_time - it.created_at
 
         machines.pop(idx)
+        del id_index[req.id]
+        rebuild_topology()
+        state_changed()
         return {"message": "Machine removed", "removed_id": req.id}
 
 @app.post("/start_simulation")
-def start_simulation():
+async def start_simulation():
     global running, _last_wall
-    with state_lock:
-        running = True
-        _last_wall = time.time()
-    ensure_thread()
+    async with state_lock:
+        if running:
+            # Already running: catch up rather than re-anchor, which would drop
+            # everything elapsed since the last event
+            advance_simulation()
+        else:
+            running = True
+            _last_wall = time.monotonic()
+        state_changed()
     return {"message": "Simulation started/resumed"}
 
 @app.post("/pause_simulation")
-def pause_simulation():
+async def pause_simulation():
     global running, _last_wall
-    with state_lock:
+    async with state_lock:
+        advance_simulation()
         running = False
-        _last_wall = time.time()
+        _last_wall = time.monotonic()
+        state_changed()
     return {"message": "Simulation paused"}
 
 @app.get("/state", response_model=StateSnapshot)
-def get_state():
-    with state_lock:
-        return StateSnapshot(**build_state_dict())
+async def get_state(request: Request):
+    snap = latest_snapshot
+    if snap["running"]:
+        return Response(content=state_payload(snap), media_type="application/json")
+
+    # Paused: the body is fully determined by the snapshot version
+    etag = f'"{_boot_id}-{snap["version"]}"'
+    headers = {"ETag": etag, "Cache-Control": "no-cache"}
+    if request.headers.get("if-none-match") == etag:
+        return Response(status_code=304, headers=headers)
+    return Response(content=state_payload(snap), media_type="application/json", headers=headers)
 
 # --- Persistence ---
+def write_file_atomic(path: str, payload: bytes):
+    """Write to a temp file beside path, fsync, then rename over it: readers see old or new, never partial."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix=".sim_state-", suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            f.write(payload)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, path)
+    except BaseException:
+        with suppress(OSError):
+            os.unlink(tmp)
+        raise
+
 @app.post("/save_state")
-def save_state():
-    with state_lock:
-        data = {
-            "sim_time": sim_time,
-            "running": running,
-            "total_started": total_started,
-            "total_completed": total_completed,
-            "cycle_times": cycle_times,
-            "item_id_seq": item_id_seq,
-            "machines": [m.model_dump() for m in machines],
-        }
-        with open(SAVE_PATH, "w") as f:
-            json.dump(data, f, indent=2)
+async def save_state():
+    async with save_lock:
+        async with state_lock:
+            advance_simulation()
+            data = {
+                "sim_time": sim_time,
+                "running": running,
+                "total_started": total_started,
+                "total_completed": total_completed,
+                "cycle_time_sum": cycle_time_sum,
+                "item_id_seq": item_id_seq,
+                "machines": [machine_to_dict(m) for m in machines],
+            }
+            payload = orjson.dumps(data, option=orjson.OPT_INDENT_2)
+        # Disk I/O happens outside state_lock and off the event loop
+        await asyncio.to_thread(write_file_atomic, SAVE_PATH, payload)
     return {"message": f"State saved to {os.path.basename(SAVE_PATH)}"}
 
 @app.post("/load_state")
-def load_state():
-    global sim_time, running, total_started, total_completed, cycle_times, item_id_seq
-    if not os.path.exists(SAVE_PATH):
+async def load_state():
+    global sim_time, running, total_started, total_completed, cycle_time_sum, item_id_seq, items_in_system
+    try:
+        # Read off the event loop, like save_state's write
+        raw = await asyncio.to_thread(Path(SAVE_PATH).read_bytes)
+    except FileNotFoundError:
         raise HTTPException(status_code=404, detail="No saved state found")
-    with state_lock:
+    # Parse and build the whole new line outside the lock; the live line is only
+    # touched once every machine came out of the file intact
+    try:
+        data = orjson.loads(raw)
+        new_machines = [machine_from_dict(md) for md in data.get("machines", [])]
+    except (orjson.JSONDecodeError, AttributeError, TypeError, ValueError) as e:
+        raise HTTPException(status_code=400, detail=f"Saved state is invalid: {e}")
+    async with state_lock:
         if running:
             raise HTTPException(status_code=400, detail="Pause simulation before loading state")
-        with open(SAVE_PATH, "r") as f:
-            data = json.load(f)
 
         sim_time = data.get("sim_time", 0.0)
         running = False
         total_started = data.get("total_started", 0)
         total_completed = data.get("total_completed", 0)
-        cycle_times = data.get("cycle_times", [])
+        # Older saves carry the full cycle_times list instead of the running sum
+        cycle_time_sum = data.get("cycle_time_sum", sum(data.get("cycle_times", [])))
         item_id_seq = data.get("item_id_seq", 0)
+        completions.clear()
 
-        machines.clear()
-        for md in data.get("machines", []):
-            md.setdefault("lane", 0)
-            machines.append(Machine(**md))
+        machines[:] = new_machines
+        items_in_system = sum(len(m.queue) + (m.current_item is not None) for m in machines)
+        id_index.clear()
+        id_index.update((m.id, m) for m in machines)
+        rebuild_topology()
+        reschedule_events()
+        state_changed()
 
     return {"message": "State restored successfully"}
 
 # --- WebSocket streaming ---
+async def snapshot_pump():
+    """Render each new snapshot once and queue the same payload for every client."""
+    while True:
+        snap = latest_snapshot
+        if ws_manager.active:
+            ws_manager.broadcast(state_payload(snap).decode())
+        await asyncio.sleep(WS_MIN_INTERVAL)
+        if latest_snapshot["version"] == snap["version"]:
+            # Nothing new yet: sleep until the next publish (paused lines can wait indefinitely)
+            with suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(snapshot_published.wait(), WS_REFRESH if snap["running"] else None)
+
 @app.websocket("/ws/state")
 async def ws_state(ws: WebSocket):
     await ws_manager.connect(ws)
+    # Current state right away; after that the pump delivers updates
+    ws_manager.send(ws, state_payload(latest_snapshot).decode())
     try:
-        while True:
-            with state_lock:
-                payload = json.dumps(build_state_dict())
-            await ws.send_text(payload)
-            await asyncio.sleep(1.0)
-    except WebSocketDisconnect:
-        ws_manager.disconnect(ws)
+        # Clients never send anything; receiving just tells us when they leave
+        while (await ws.receive())["type"] != "websocket.disconnect":
+            pass
     except Exception as e:
         print("WS error:", repr(e))
+    finally:
         ws_manager.disconnect(ws)
 
 # --- Reset endpoint ---
 @app.post("/reset_simulation")
-def reset_simulation():
-    global running, sim_time, _last_wall, total_started, total_completed, cycle_times, item_id_seq
-    with state_lock:
+async def reset_simulation():
+    global running, sim_time, _last_wall, total_started, total_completed, cycle_time_sum, item_id_seq, items_in_system
+    async with state_lock:
         running = False
         sim_time = 0.0
-        _last_wall = time.time()
+        _last_wall = time.monotonic()
         total_started = 0
         total_completed = 0
-        cycle_times = []
+        items_in_system = 0
+        cycle_time_sum = 0.0
         item_id_seq = 0
+        completions.clear()
         for m in machines:
-            m.in_progress.clear()
+            m.current_item = None
+            m.finish_time = math.inf
             m.queue.clear()
             m.completed = 0
-            m.busy_time = 0.0
+            m.busy_time_base = 0.0
+            m.completed_at_base = 0
             m.last_state_change = 0.0
             m.blocked = False
+        event_heap.clear()
+        state_changed()
     return {"message": "Simulation reset (paused). Click Start to run."}
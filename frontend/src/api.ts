@@ -18,6 +18,7 @@ export type StateSnapshot = {
   total_started: number;
   total_completed: number;
   avg_cycle_time: number;
+  rolling_throughput: number; // items/s over the last 60 s of sim time
   running: boolean;
   machines: Array<{
     id: number;